@@ -19,10 +19,21 @@ EXTRACTED_IMAGE_FILENAME = 'extracted.img'
 INT = Interrupt     # shorthand for Interrupt
 
 class Trap(Exception):
+    '''CPU trap. The message is a format string with its arguments; it is only
+    formatted when the trap is actually displayed.'''
     def __init__(self, num, *args):
         Exception.__init__(self, *args)
         self.num = num
 
+    def __str__(self):
+        if not self.args:
+            return ''
+        return self.args[0].format(*self.args[1:])
+
+class Suspend(Exception):
+    '''Raised by HALT and WAIT to end the current batch of steps in run()'''
+    pass
+
 class Page:
     def __init__(self, par, pdr):
         self.par = par
@@ -32,6 +43,12 @@ class Page:
         self.read = (pdr & 2) == 2
         self.write = (pdr & 6) == 6
         self.ed = (pdr & 8) == 8
+        # Precomputed for decode(): physical base address and the range of valid 13-bit offsets
+        self.base = self.addr << 6
+        if self.ed:
+            self.lo, self.hi = self.len << 6, 0o17777
+        else:
+            self.lo, self.hi = 0, (self.len << 6) | 0o77
 
 class PDP11:
 
@@ -68,6 +85,8 @@ class PDP11:
 
     RS = ["R0", "R1", "R2", "R3", "R4", "R5", "SP", "PC"]
 
+    STEPS_PER_BATCH = 16    # instructions executed between checks for pending interrupts
+
     def __init__(self):
         # TODO: why are these not in reset()
         self.prdebug = False
@@ -84,6 +103,10 @@ class PDP11:
         # Magnetic disk drive
         self.rk = RK05(self)
 
+        # Operand address decoders, indexed by addressing mode
+        self._aget_tab = [self._aget_reg, self._aget_regdef, self._aget_autoinc, self._aget_autoincdef,
+                          self._aget_autodec, self._aget_autodecdef, self._aget_index, self._aget_indexdef]
+
         self.reset()
     
     def place_window(self, master):
@@ -109,7 +132,7 @@ class PDP11:
         self.PS = 0         # processor status
         self.curPC = 0      # address of current instruction
         self.instr = 0      # current instruction
-        self.memory = array.array('H', bytearray(256*1024*[0]))     # 128K of 16-bit unsigned values
+        self.memory = array.array('H', bytearray(256*1024))     # 128K of 16-bit unsigned values
         self.iter_cnt = 0
         self.step_cnt = 0   # unlike iter_cnt doesn't get reset by clock interrupt
         self.SR0 = 0
@@ -154,7 +177,7 @@ class PDP11:
 
     def physread16(self, addr):
         if addr & 1:
-            raise(Trap(INT.BUS, 'read from odd address ' + ostr(addr,6)))
+            raise(Trap(INT.BUS, "read from odd address {:06o}", addr))
         if addr < 0o760000:
             return self.memory[addr>>1]
         if addr == 0o777546:
@@ -175,7 +198,7 @@ class PDP11:
             return self.mmuread16(addr)
         if addr == 0o776000:
             self.panic('lolwut')
-        raise(Trap(INT.BUS, 'read from invalid address ' + ostr(addr,6)))
+        raise(Trap(INT.BUS, "read from invalid address {:06o}", addr))
 
 
     def physread8(self, addr):
@@ -200,7 +223,7 @@ class PDP11:
 
     def physwrite16(self, a, v):
         if a % 1:
-            raise(Trap(INT.BUS, "write to odd address " + ostr(a,6)))
+            raise(Trap(INT.BUS, "write to odd address {:06o}", a))
         if a < 0o760000:
             try:
                 self.memory[a>>1] = v
@@ -240,44 +263,47 @@ class PDP11:
         elif (a & 0o777600) == 0o772200 or (a & 0o777600) == 0o777600:
             self.mmuwrite16(a,v)
         else:
-            raise(Trap(INT.BUS, "write to invalid address " + ostr(a,6)))
+            raise(Trap(INT.BUS, "write to invalid address {:06o}", a))
 
 
     def decode(self, a, w, m):
-        #var p, user, block, disp
         if not (self.SR0 & 1):
             if a >= 0o170000:
                 a += 0o600000
             return a
+        p = self.pages[(a >> 13) + (8 if m else 0)]
+        off = a & 0o17777
+        if (p.write if w else p.read) and p.lo <= off <= p.hi:
+            if w:
+                p.pdr |= 1<<6
+            return p.base + off
+        self.pagefault(a, w, m, p)
+
+    def pagefault(self, a, w, m, p):
+        '''Slow path of decode(): sets SR0/SR2 and raises the MMU trap'''
         user = 8 if m else 0
-        p = self.pages[(a >> 13) + user]
         if w and not p.write:
             self.SR0 = (1<<13) | 1
             self.SR0 |= (a >> 12) & ~1
             if user:
                 self.SR0 |= (1<<5) | (1<<6)
             self.SR2 = self.curPC
-            raise(Trap(INT.FAULT, "write to read-only page " + ostr(a,6)))
+            raise(Trap(INT.FAULT, "write to read-only page {:06o}", a))
         if not p.read:
             self.SR0 = (1<<15) | 1
             self.SR0 |= (a >> 12) & ~1
             if user:
                 self.SR0 |= (1<<5)|(1<<6)
             self.SR2 = self.curPC
-            raise(Trap(INT.FAULT, "read from no-access page " + ostr(a,6)))
+            raise(Trap(INT.FAULT, "read from no-access page {:06o}", a))
         block = (a >> 6) & 0o177
-        disp = a & 0o77
-        if (p.ed and (block < p.len)) or (not p.ed and (block > p.len)):
-                self.SR0 = (1<<14) | 1
-                self.SR0 |= (a >> 12) & ~1
-                if user:
-                    self.SR0 |= (1<<5)|(1<<6)
-                self.SR2 = self.curPC
-                raise(Trap(INT.FAULT, "page length exceeded, address " + ostr(a,6) + " (block " + \
-                      ostr(block,3) + ") is beyond length " + ostr(p.len,3)))
-        if w:
-            p.pdr |= 1<<6
-        return ((block + p.addr) << 6) + disp
+        self.SR0 = (1<<14) | 1
+        self.SR0 |= (a >> 12) & ~1
+        if user:
+            self.SR0 |= (1<<5)|(1<<6)
+        self.SR2 = self.curPC
+        raise(Trap(INT.FAULT, "page length exceeded, address {:06o} (block {:03o}) is beyond length {:03o}",
+                   a, block, p.len))
 
 
     def mmuread16(self, a):
@@ -290,7 +316,7 @@ class PDP11:
                 return self.pages[i+8].pdr
         if (a >= 0o777640) and (a < 0o777660):
                 return self.pages[i+8].par
-        raise(Trap(INT.BUS, "invalid read from " + ostr(a,6)))
+        raise(Trap(INT.BUS, "invalid read from {:06o}", a))
 
 
     def mmuwrite16(self, a, v):
@@ -304,7 +330,7 @@ class PDP11:
         elif (a >= 0o777640) and (a < 0o777660):
             self.pages[i+8] = Page(v, self.pages[i+8].pdr)
         else:
-            raise(Trap(INT.BUS, "write to invalid address " + ostr(a,6)))
+            raise(Trap(INT.BUS, "write to invalid address {:06o}", a))
 
     def read8(self, a):
         return self.physread8(self.decode(a, False, self.curuser))
@@ -318,20 +344,10 @@ class PDP11:
     def write16(self, a, v):
         return self.physwrite16(self.decode(a, True, self.curuser), v)
 
-    def fetch16(self):
-        val = self.read16(self.R[7])
-        self.R[7] += 2
-        return val
-
     def push(self, v):
         self.R[6] -= 2
         self.write16(self.R[6], v)
 
-    def pop(self):
-        val = self.read16(self.R[6])
-        self.R[6] += 2
-        return val
-
     def disasmaddr(self, m, a):
         if (m & 7) == 7:
             if m ==  0o27:
@@ -500,18 +516,19 @@ class PDP11:
             self.push(prev)
             self.push(self.R[7])
         except Trap as e:
-            self.trapat(e.num, str(e))
+            self.trapat(e.num, e)
         self.R[7] = self.memory[vec>>1]
         self.PS = self.memory[(vec>>1)+1]
         if self.prevuser:
             self.PS |= (1<<13) | (1<<12)
 
     def trapat(self, vec, msg):
-        #var prev;
+        # `msg` can be the Trap itself: it's only formatted when debugging
         if vec & 1:
             self.panic("Thou darst calling trapat() with an odd vector number?")
-        self.writedebug("trap " + ostr(vec) + " occurred: " + msg + "\n")
-        self.printstate()
+        if self.prdebug:
+            self.writedebug("trap " + ostr(vec) + " occurred: " + str(msg) + "\n")
+            self.printstate()
         try:
             prev = self.PS
             self.switchmode(False)
@@ -532,29 +549,49 @@ class PDP11:
         self.running.set()
 
 
-    def aget(self, v, l):
-        #var addr
-        if (v & 7) >= 6 or (v & 0o10):
-            l = 2
-        if (v & 0o70) == 0o00:
-            return -(v + 1)
-        bits = v & 0o60
-        if bits == 0o00:
-            v &= 7
-            addr = self.R[v & 7]
-        elif bits == 0o20:
-            addr = self.R[v & 7]
-            self.R[v & 7] += l
-        elif bits == 0o40:
-            self.R[v & 7] -= l
-            addr = self.R[v & 7]
-        elif bits == 0o60:
-            addr = self.fetch16()
-            addr += self.R[v & 7]
-        addr &= 0xFFFF
-        if v & 0o10:
-            addr = self.read16(addr)
-        return addr
+    # Addressing modes 0-7, dispatched by step() via self._aget_tab[mode](reg, l);
+    # each returns the operand address, negative for registers.
+    # Autoincrement/autodecrement always step SP and PC by 2; deferred modes always fetch a word.
+
+    def _aget_reg(self, r, l):
+        return -(r + 1)
+
+    def _aget_regdef(self, r, l):
+        return self.R[r] & 0xFFFF
+
+    def _aget_autoinc(self, r, l):
+        R = self.R
+        addr = R[r]
+        R[r] += 2 if r >= 6 else l
+        return addr & 0xFFFF
+
+    def _aget_autoincdef(self, r, l):
+        R = self.R
+        addr = R[r]
+        R[r] += 2
+        return self.read16(addr & 0xFFFF)
+
+    def _aget_autodec(self, r, l):
+        R = self.R
+        R[r] -= 2 if r >= 6 else l
+        return R[r] & 0xFFFF
+
+    def _aget_autodecdef(self, r, l):
+        R = self.R
+        R[r] -= 2
+        return self.read16(R[r] & 0xFFFF)
+
+    def _aget_index(self, r, l):
+        R = self.R
+        addr = self.read16(R[7])
+        R[7] += 2
+        return (addr + R[r]) & 0xFFFF
+
+    def _aget_indexdef(self, r, l):
+        R = self.R
+        addr = self.read16(R[7])
+        R[7] += 2
+        return self.read16((addr + R[r]) & 0xFFFF)
 
 
     def memread(self, a, l):
@@ -581,12 +618,6 @@ class PDP11:
             self.write8(a, v)
 
 
-    def branch(self, o):
-        if o & 0x80:
-            o = -(((~o)+1)&0xFF)
-        o <<= 1
-        self.R[7] += o
-
     def extract_image(self):
         # Called on PyPDP11 interrupt
         self.rk.save_image(EXTRACTED_IMAGE_FILENAME)
@@ -608,16 +639,16 @@ class PDP11:
 
     def step(self):
         #var val, val1, val2, ia, da, sa, d, s, l, r, o, max, maxp, msb;
-        self.iter_cnt += 1
-        self.step_cnt += 1
-        self.curPC = self.R[7]
-        ia = self.decode(self.R[7], False, self.curuser)            # instruction address
-        self.R[7] += 2
-        self.instr = self.physread16(ia)
-        d = self.instr & 0o77
-        s = (self.instr & 0o7700) >> 6
-        l = 2 - (self.instr >> 15)
-        o = self.instr & 0xFF
+        R = self.R
+        aget = self._aget_tab
+        pc = self.curPC = R[7]
+        ia = self.decode(pc, False, self.curuser)              # instruction address
+        R[7] = pc + 2
+        instr = self.instr = self.physread16(ia)
+        d = instr & 0o77
+        s = (instr & 0o7700) >> 6
+        l = 2 - (instr >> 15)
+        o = instr & 0xFF
         if l == 2:
             max = 0xFFFF
             maxp = 0x7FFF
@@ -628,15 +659,11 @@ class PDP11:
             msb = 0x80
 
         # MOV / CMP / BIT / BIC / BIS
-        bits = self.instr & 0o070000
+        bits = instr & 0o070000
         if bits == 0o010000: # MOV
-            sa = self.aget(s, l); val = self.memread(sa, l)
-            da = self.aget(d, l)
-            self.PS &= 0xFFF1
-            if val & msb:
-                self.PS |= PDP11.FLAGN
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
+            sa = aget[s >> 3](s & 7, l); val = self.memread(sa, l)
+            da = aget[d >> 3](d & 7, l)
+            self.PS = (self.PS & 0xFFF1) | ((val & msb != 0) << 3) | ((val == 0) << 2)
             if da < 0 and l == 1:
                 l = 2
                 if val & msb:
@@ -644,104 +671,120 @@ class PDP11:
             self.memwrite(da, l, val)
             return
         elif bits == 0o020000: # CMP
-            sa = self.aget(s, l); val1 = self.memread(sa, l)
-            da = self.aget(d, l); val2 = self.memread(da, l)
+            sa = aget[s >> 3](s & 7, l); val1 = self.memread(sa, l)
+            da = aget[d >> 3](d & 7, l); val2 = self.memread(da, l)
             val = (val1 - val2) & max
-            self.PS &= 0xFFF0
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & msb:
-                self.PS |= PDP11.FLAGN
-            if ((val1 ^ val2) & msb) and not ((val2 ^ val) & msb):
-                self.PS |= PDP11.FLAGV
-            if val1 < val2:
-                self.PS |= PDP11.FLAGC
+            self.PS = (self.PS & 0xFFF0) | ((val & msb != 0) << 3) | ((val == 0) << 2) \
+                    | (((val1 ^ val2) & ~(val2 ^ val) & msb != 0) << 1) | (val1 < val2)
             return
         elif bits == 0o030000: # BIT
-            sa = self.aget(s, l); val1 = self.memread(sa, l)
-            da = self.aget(d, l); val2 = self.memread(da, l)
+            sa = aget[s >> 3](s & 7, l); val1 = self.memread(sa, l)
+            da = aget[d >> 3](d & 7, l); val2 = self.memread(da, l)
             val = val1 & val2
-            self.PS &= 0xFFF1
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & msb:
-                self.PS |= PDP11.FLAGN
+            self.PS = (self.PS & 0xFFF1) | ((val & msb != 0) << 3) | ((val == 0) << 2)
             return
         elif bits == 0o040000: # BIC
-            sa = self.aget(s, l); val1 = self.memread(sa, l)
-            da = self.aget(d, l); val2 = self.memread(da, l)
+            sa = aget[s >> 3](s & 7, l); val1 = self.memread(sa, l)
+            da = aget[d >> 3](d & 7, l); val2 = self.memread(da, l)
             val = (max ^ val1) & val2
-            self.PS &= 0xFFF1
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & msb:
-                self.PS |= PDP11.FLAGN
+            self.PS = (self.PS & 0xFFF1) | ((val & msb != 0) << 3) | ((val == 0) << 2)
             self.memwrite(da, l, val)
             return
         elif bits == 0o050000: # BIS
-            sa = self.aget(s, l); val1 = self.memread(sa, l)
-            da = self.aget(d, l); val2 = self.memread(da, l)
+            sa = aget[s >> 3](s & 7, l); val1 = self.memread(sa, l)
+            da = aget[d >> 3](d & 7, l); val2 = self.memread(da, l)
             val = val1 | val2
-            self.PS &= 0xFFF1
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & msb:
-                self.PS |= PDP11.FLAGN
+            self.PS = (self.PS & 0xFFF1) | ((val & msb != 0) << 3) | ((val == 0) << 2)
             self.memwrite(da, l, val)
             return
 
         # ADD / SUB
-        bits = self.instr & 0o170000
+        bits = instr & 0o170000
         if bits == 0o060000: # ADD
-            sa = self.aget(s, 2); val1 = self.memread(sa, 2)
-            da = self.aget(d, 2); val2 = self.memread(da, 2)
+            sa = aget[s >> 3](s & 7, 2); val1 = self.memread(sa, 2)
+            da = aget[d >> 3](d & 7, 2); val2 = self.memread(da, 2)
             val = (val1 + val2) & 0xFFFF
-            self.PS &= 0xFFF0
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & 0x8000:
-                self.PS |= PDP11.FLAGN
-            if not ((val1 ^ val2) & 0x8000) and ((val2 ^ val) & 0x8000):
-                self.PS |= PDP11.FLAGV
-            if val1 + val2 >= 0xFFFF:
-                self.PS |= PDP11.FLAGC
+            # N is bit 15 shifted to bit 3, V is bit 15 of the overflow term shifted to bit 1
+            self.PS = (self.PS & 0xFFF0) | ((val >> 12) & 8) | ((val == 0) << 2) \
+                    | (((~(val1 ^ val2) & (val2 ^ val)) >> 14) & 2) | (val1 + val2 >= 0xFFFF)
             self.memwrite(da, 2, val)
             return
         elif bits == 0o160000: # SUB
-            sa = self.aget(s, 2); val1 = self.memread(sa, 2)
-            da = self.aget(d, 2); val2 = self.memread(da, 2)
+            sa = aget[s >> 3](s & 7, 2); val1 = self.memread(sa, 2)
+            da = aget[d >> 3](d & 7, 2); val2 = self.memread(da, 2)
             val = (val2 - val1) & 0xFFFF
-            self.PS &= 0xFFF0
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & 0x8000:
-                self.PS |= PDP11.FLAGN
-            if ((val1 ^ val2) & 0x8000) and not ((val2 ^ val) & 0x8000):
-                self.PS |= PDP11.FLAGV
-            if val1 > val2:
-                self.PS |= PDP11.FLAGC
+            self.PS = (self.PS & 0xFFF0) | ((val >> 12) & 8) | ((val == 0) << 2) \
+                    | ((((val1 ^ val2) & ~(val2 ^ val)) >> 14) & 2) | (val1 > val2)
             self.memwrite(da, 2, val)
             return
 
+        # Branches (~20% of instructions executed by Unix V6)
+        if not (instr & 0o074000) and (instr & 0o103400):
+            PS = self.PS
+            nxv = ((PS >> 3) ^ (PS >> 1)) & 1       # N xor V
+            bits = instr & 0o177400
+            if bits == 0o001000:    # BNE
+                taken = not (PS & PDP11.FLAGZ)
+            elif bits == 0o101000:  # BHI
+                taken = not (PS & (PDP11.FLAGC | PDP11.FLAGZ))
+            elif bits == 0o103400:  # BCS
+                taken = PS & PDP11.FLAGC
+            elif bits == 0o001400:  # BEQ
+                taken = PS & PDP11.FLAGZ
+            elif bits == 0o000400:  # BR
+                taken = True
+            elif bits == 0o103000:  # BCC
+                taken = not (PS & PDP11.FLAGC)
+            elif bits == 0o002400:  # BLT
+                taken = nxv
+            elif bits == 0o003000:  # BGT
+                taken = not nxv and not (PS & PDP11.FLAGZ)
+            elif bits == 0o002000:  # BGE
+                taken = not nxv
+            elif bits == 0o003400:  # BLE
+                taken = nxv or (PS & PDP11.FLAGZ)
+            elif bits == 0o100000:  # BPL
+                taken = not (PS & PDP11.FLAGN)
+            elif bits == 0o100400:  # BMI
+                taken = PS & PDP11.FLAGN
+            elif bits == 0o101400:  # BLOS
+                taken = PS & (PDP11.FLAGC | PDP11.FLAGZ)
+            elif bits == 0o102000:  # BVC
+                taken = not (PS & PDP11.FLAGV)
+            else:                   # BVS
+                taken = PS & PDP11.FLAGV
+            if taken:
+                R[7] += ((o ^ 0x80) - 0x80) << 1     # `o` is a signed offset in words
+            return
+
         # JSR / MUL / DIV / ASH / ASHC / XOR / SOB
-        bits = self.instr & 0o177000
-        if bits == 0o004000: # JSR
-            val = self.aget(d, l)
+        bits = instr & 0o177000
+        if bits == 0o077000: # SOB
+            R[s & 7] -= 1
+            if R[s & 7]:
+                o &= 0o77
+                o <<= 1
+                R[7] -= o
+            return
+        elif bits == 0o004000: # JSR
+            val = aget[d >> 3](d & 7, l)
             if val >= 0:
-                self.push(self.R[s & 7])
-                self.R[s & 7] = self.R[7]
-                self.R[7] = val
+                val1 = R[s & 7]
+                R[6] -= 2
+                self.write16(R[6], val1)
+                R[s & 7] = R[7]
+                R[7] = val
                 return
         elif bits == 0o070000: # MUL
-            val1 = self.R[s & 7]
+            val1 = R[s & 7]
             if val1 & 0x8000:
                 val1 = -((0xFFFF^val1)+1)
-            da = self.aget(d, l); val2 = self.memread(da, 2)
+            da = aget[d >> 3](d & 7, l); val2 = self.memread(da, 2)
             if val2 & 0x8000:
                 val2 = -((0xFFFF^val2)+1)
             val = val1 * val2
-            self.R[s & 7] = (val & 0xFFFF0000) >> 16
-            self.R[(s & 7)|1] = val & 0xFFFF
+            R[s & 7] = (val & 0xFFFF0000) >> 16
+            R[(s & 7)|1] = val & 0xFFFF
             self.PS &= 0xFFF0
             if val & 0x80000000:
                 self.PS |= PDP11.FLAGN
@@ -751,8 +794,8 @@ class PDP11:
                 self.PS |= PDP11.FLAGC
             return
         elif bits == 0o071000: # DIV
-            val1 = (self.R[s & 7] << 16) | self.R[(s & 7) | 1]
-            da = self.aget(d, l); val2 = self.memread(da, 2)
+            val1 = (R[s & 7] << 16) | R[(s & 7) | 1]
+            da = aget[d >> 3](d & 7, l); val2 = self.memread(da, 2)
             self.PS &= 0xFFF0
             if val2 == 0:
                 self.PS |= PDP11.FLAGC
@@ -760,18 +803,18 @@ class PDP11:
             if (val1 / val2) >= 0x10000:
                 self.PS |= PDP11.FLAGV
                 return
-            self.R[s & 7] = (val1 // val2) & 0xFFFF
-            self.R[(s & 7) | 1] = (val1 % val2) & 0xFFFF
-            if self.R[s & 7] == 0:
+            R[s & 7] = (val1 // val2) & 0xFFFF
+            R[(s & 7) | 1] = (val1 % val2) & 0xFFFF
+            if R[s & 7] == 0:
                 self.PS |= PDP11.FLAGZ
-            if self.R[s & 7] & 0o100000:
+            if R[s & 7] & 0o100000:
                 self.PS |= PDP11.FLAGN
             if val1 == 0:
                 self.PS |= PDP11.FLAGV
             return
         elif bits == 0o072000: # ASH
-            val1 = self.R[s & 7]
-            da = self.aget(d, 2); val2 = self.memread(da, 2) & 0o77
+            val1 = R[s & 7]
+            da = aget[d >> 3](d & 7, 2); val2 = self.memread(da, 2) & 0o77
             self.PS &= 0xFFF0
             if val2 & 0o40:
                 val2 = (0o77 ^ val2) + 1
@@ -786,7 +829,7 @@ class PDP11:
                 val = (val1 << val2) & 0xFFFF
                 if val1 & (1 << (16 - val2)):
                     self.PS |= PDP11.FLAGC
-            self.R[s & 7] = val
+            R[s & 7] = val
             if val == 0:
                 self.PS |= PDP11.FLAGZ
             if val & 0o100000:
@@ -795,8 +838,8 @@ class PDP11:
                 self.PS |= PDP11.FLAGV
             return
         elif bits == 0o073000: # ASHC
-            val1 = (self.R[s & 7] << 16) | self.R[(s & 7) | 1]
-            da = self.aget(d, 2); val2 = self.memread(da, 2) & 0o77
+            val1 = (R[s & 7] << 16) | R[(s & 7) | 1]
+            da = aget[d >> 3](d & 7, 2); val2 = self.memread(da, 2) & 0o77
             self.PS &= 0xFFF0
             if val2 & 0o40:
                 val2 = (0o77 ^ val2) + 1
@@ -811,8 +854,8 @@ class PDP11:
                 val = (val1 << val2) & 0xFFFFFFFF
                 if val1 & (1 << (32 - val2)):
                     self.PS |= PDP11.FLAGC
-            self.R[s & 7] = (val >> 16) & 0xFFFF
-            self.R[(s & 7)|1] = val & 0xFFFF
+            R[s & 7] = (val >> 16) & 0xFFFF
+            R[(s & 7)|1] = val & 0xFFFF
             if val == 0:
                 self.PS |= PDP11.FLAGZ
             if val & 0x80000000:
@@ -821,8 +864,8 @@ class PDP11:
                 self.PS |= PDP11.FLAGV
             return
         elif bits == 0o074000: # XOR
-            val1 = self.R[s & 7]
-            da = self.aget(d, 2); val2 = self.memread(da, 2)
+            val1 = R[s & 7]
+            da = aget[d >> 3](d & 7, 2); val2 = self.memread(da, 2)
             val = val1 ^ val2
             self.PS &= 0xFFF1
             if val == 0:
@@ -831,70 +874,45 @@ class PDP11:
                 self.PS |= PDP11.FLAGZ
             self.memwrite(da, 2, val)
             return
-        elif bits == 0o077000: # SOB
-            self.R[s & 7] -= 1
-            if self.R[s & 7]:
-                o &= 0o77
-                o <<= 1
-                self.R[7] -= o
-            return
 
         # CLR / COM / INC / DEC / NEG / ADC / SBC / TST / ROL / ROR / ASL / AST / SXT
-        bits = self.instr & 0o077700
+        bits = instr & 0o077700
         if bits == 0o005000: # CLR
-            self.PS &= 0xFFF0
-            self.PS |= PDP11.FLAGZ
-            da = self.aget(d, l)
+            self.PS = (self.PS & 0xFFF0) | PDP11.FLAGZ
+            da = aget[d >> 3](d & 7, l)
             self.memwrite(da, l, 0)
             return
-        elif bits == 0o005100: # COM
-            da = self.aget(d, l)
-            val = self.memread(da, l) ^ max
-            self.PS &= 0xFFF0; self.PS |= PDP11.FLAGC
-            if val & msb:
-                self.PS |= PDP11.FLAGN
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            self.memwrite(da, l, val)
+        elif bits == 0o005700: # TST
+            da = aget[d >> 3](d & 7, l)
+            val = self.memread(da, l)
+            self.PS = (self.PS & 0xFFF0) | ((val & msb != 0) << 3) | ((val == 0) << 2)
             return
         elif bits == 0o005200: # INC
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = (self.memread(da, l) + 1) & max
-            self.PS &= 0xFFF1
-            if val & msb:
-                self.PS |= PDP11.FLAGN | PDP11.FLAGV
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
+            self.PS = (self.PS & 0xFFF1) | ((val & msb != 0) * (PDP11.FLAGN | PDP11.FLAGV)) | ((val == 0) << 2)
             self.memwrite(da, l, val)
             return
         elif bits == 0o005300: # DEC
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = (self.memread(da, l) - 1) & max
-            self.PS &= 0xFFF1
-            if val & msb:
-                self.PS |= PDP11.FLAGN
-            if val == maxp:
-                self.PS |= PDP11.FLAGV
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
+            self.PS = (self.PS & 0xFFF1) | ((val & msb != 0) << 3) | ((val == 0) << 2) | ((val == maxp) << 1)
+            self.memwrite(da, l, val)
+            return
+        elif bits == 0o005100: # COM
+            da = aget[d >> 3](d & 7, l)
+            val = self.memread(da, l) ^ max
+            self.PS = (self.PS & 0xFFF0) | ((val & msb != 0) << 3) | ((val == 0) << 2) | PDP11.FLAGC
             self.memwrite(da, l, val)
             return
         elif bits == 0o005400: # NEG
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = (-self.memread(da, l)) & max
-            self.PS &= 0xFFF0
-            if val & msb:
-                self.PS |= PDP11.FLAGN
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            else:
-                self.PS |= PDP11.FLAGC
-            if val == 0x8000:
-                self.PS |= PDP11.FLAGV
+            self.PS = (self.PS & 0xFFF0) | ((val & msb != 0) << 3) | ((val == 0) << 2) | ((val == 0x8000) << 1) | (val != 0)
             self.memwrite(da, l, val)
             return
         elif bits == 0o005500: # ADC
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = self.memread(da, l)
             if self.PS & PDP11.FLAGC:
                 self.PS &= 0xFFF0
@@ -915,7 +933,7 @@ class PDP11:
                     self.PS |= PDP11.FLAGZ
             return
         elif bits == 0o005600: # SBC
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = self.memread(da, l)
             if self.PS & PDP11.FLAGC:
                 self.PS &= 0xFFF0
@@ -938,17 +956,8 @@ class PDP11:
                     self.PS |= PDP11.FLAGV
                 self.PS |= PDP11.FLAGC
             return
-        elif bits == 0o005700: # TST
-            da = self.aget(d, l)
-            val = self.memread(da, l)
-            self.PS &= 0xFFF0
-            if val & msb:
-                self.PS |= PDP11.FLAGN
-            if val == 0:
-                self.PS |= PDP11.FLAGZ
-            return
         elif bits == 0o006000: # ROR
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = self.memread(da, l)
             if self.PS & PDP11.FLAGC:
                 val |= max+1
@@ -965,7 +974,7 @@ class PDP11:
             self.memwrite(da, l, val)
             return
         elif bits == 0o006100: # ROL
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = self.memread(da, l) << 1
             if self.PS & PDP11.FLAGC:
                 val |= 1
@@ -982,7 +991,7 @@ class PDP11:
             self.memwrite(da, l, val)
             return
         elif bits == 0o006200: # ASR
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = self.memread(da, l)
             self.PS &= 0xFFF0
             if val & 1:
@@ -997,7 +1006,7 @@ class PDP11:
             self.memwrite(da, l, val)
             return
         elif bits == 0o006300: # ASL
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             val = self.memread(da, l)
             self.PS &= 0xFFF0
             if val & msb:
@@ -1012,7 +1021,7 @@ class PDP11:
             self.memwrite(da, l, val)
             return
         elif bits == 0o006700: # SXT
-            da = self.aget(d, l)
+            da = aget[d >> 3](d & 7, l)
             if self.PS & PDP11.FLAGN:
                 self.memwrite(da, l, max)
             else:
@@ -1021,178 +1030,127 @@ class PDP11:
             return
 
         # JMP / SWAB / MARK / MFPI / MTPI
-        bits = self.instr & 0o177700
-        if bits == 0o000100: # JMP
-            val = self.aget(d, 2)
-            if val >= 0:
-                self.R[7] = val
-                return
-        elif bits == 0o000300: # SWAB
-            da = self.aget(d, l)
-            val = self.memread(da, l)
-            val = ((val >> 8) | (val << 8)) & 0xFFFF
-            self.PS &= 0xFFF0
-            if (val & 0xFF) == 0:
-                self.PS |= PDP11.FLAGZ
-            if val & 0x80:
-                self.PS |= PDP11.FLAGN
-            self.memwrite(da, l, val)
-            return
-        elif bits == 0o006400: # MARK
-            self.R[6] = self.R[7] + (self.instr & 0o77) << 1
-            self.R[7] = self.R[5]
-            self.R[5] = self.pop()
-            # TODO: no return here?
-        elif bits == 0o006500: # MFPI
-            da = self.aget(d, 2)
+        bits = instr & 0o177700
+        if bits == 0o006600: # MTPI
+            da = aget[d >> 3](d & 7, 2)
+            val = self.read16(R[6])
+            R[6] += 2
             if da == -7:
-                val = self.R[6] if (self.curuser == self.prevuser) else (self.USP if self.prevuser else self.KSP)
+                if self.curuser == self.prevuser:
+                    R[6] = val
+                elif self.prevuser:
+                    self.USP = val
+                else:
+                    self.KSP = val
             elif da < 0:
-                self.panic("invalid MFPI instruction")
+                self.panic("invalid MTPI instrution")
             else:
-                val = self.physread16(self.decode(da, False, self.prevuser))
-            self.push(val)
+                sa = self.decode(da, True, self.prevuser)
+                self.physwrite16(sa, val)
             self.PS &= 0xFFF0; self.PS |= PDP11.FLAGC
             if val == 0:
                 self.PS |= PDP11.FLAGZ
             if val & 0x8000:
                 self.PS |= PDP11.FLAGN
             return
-        elif bits == 0o006600: # MTPI
-            da = self.aget(d, 2)
-            val = self.pop()
+        elif bits == 0o000100: # JMP
+            val = aget[d >> 3](d & 7, 2)
+            if val >= 0:
+                R[7] = val
+                return
+        elif bits == 0o006500: # MFPI
+            da = aget[d >> 3](d & 7, 2)
             if da == -7:
-                if self.curuser == self.prevuser:
-                    self.R[6] = val
-                elif self.prevuser:
-                    self.USP = val
-                else:
-                    self.KSP = val
+                val = R[6] if (self.curuser == self.prevuser) else (self.USP if self.prevuser else self.KSP)
             elif da < 0:
-                self.panic("invalid MTPI instrution")
+                self.panic("invalid MFPI instruction")
             else:
-                sa = self.decode(da, True, self.prevuser)
-                self.physwrite16(sa, val)
+                val = self.physread16(self.decode(da, False, self.prevuser))
+            R[6] -= 2
+            self.write16(R[6], val)
             self.PS &= 0xFFF0; self.PS |= PDP11.FLAGC
             if val == 0:
                 self.PS |= PDP11.FLAGZ
             if val & 0x8000:
                 self.PS |= PDP11.FLAGN
             return
+        elif bits == 0o000300: # SWAB
+            da = aget[d >> 3](d & 7, l)
+            val = self.memread(da, l)
+            val = ((val >> 8) | (val << 8)) & 0xFFFF
+            self.PS &= 0xFFF0
+            if (val & 0xFF) == 0:
+                self.PS |= PDP11.FLAGZ
+            if val & 0x80:
+                self.PS |= PDP11.FLAGN
+            self.memwrite(da, l, val)
+            return
+        elif bits == 0o006400: # MARK
+            R[6] = R[7] + (instr & 0o77) << 1
+            R[7] = R[5]
+            val = self.read16(R[6])
+            R[6] += 2
+            R[5] = val
+            # TODO: no return here?
 
         # RTS
-        if (self.instr & 0o177770) == 0o000200:
-            self.R[7] = self.R[d & 7]
-            self.R[d & 7] = self.pop()
+        if (instr & 0o177770) == 0o000200:
+            R[7] = R[d & 7]
+            val = self.read16(R[6])
+            R[6] += 2
+            R[d & 7] = val
             return
     
-        # TODO: what are these?
-        bits = self.instr & 0o177400
-        if bits == 0o000400:
-            self.branch(o)
-            return
-        elif bits == 0o001000:
-            if not (self.PS & PDP11.FLAGZ):
-                self.branch(o)
-            return
-        elif bits == 0o001400:
-            if self.PS & PDP11.FLAGZ:
-                self.branch(o)
-            return
-        elif bits == 0o002000:
-            if not self._xor(self.PS & PDP11.FLAGN, self.PS & PDP11.FLAGV):
-                self.branch(o)
-            return
-        elif bits == 0o002400:
-            if self._xor(self.PS & PDP11.FLAGN, self.PS & PDP11.FLAGV):
-                self.branch(o)
-            return
-        elif bits == 0o003000:
-            if not self._xor(self.PS & PDP11.FLAGN, self.PS & PDP11.FLAGV) and not (self.PS & PDP11.FLAGZ):
-                self.branch(o)
-            return
-        elif bits == 0o003400:
-            if self._xor(self.PS & PDP11.FLAGN, self.PS & PDP11.FLAGV) or (self.PS & PDP11.FLAGZ):
-                self.branch(o)
-            return
-        elif bits == 0o100000:
-            if not (self.PS & PDP11.FLAGN):
-                self.branch(o)
-            return
-        elif bits == 0o100400:
-            if self.PS & PDP11.FLAGN:
-                self.branch(o)
-            return
-        elif bits == 0o101000:
-            if not (self.PS & PDP11.FLAGC) and not (self.PS & PDP11.FLAGZ):
-                self.branch(o)
-            return
-        elif bits == 0o101400:
-            if (self.PS & PDP11.FLAGC) or (self.PS & PDP11.FLAGZ):
-                self.branch(o)
-            return
-        elif bits == 0o102000:
-            if not (self.PS & PDP11.FLAGV):
-                self.branch(o)
-            return
-        elif bits == 0o102400:
-            if self.PS & PDP11.FLAGV:
-                self.branch(o)
-            return
-        elif bits == 0o103000:
-            if not (self.PS & PDP11.FLAGC):
-                self.branch(o)
-            return
-        elif bits == 0o103400:
-            if self.PS & PDP11.FLAGC:
-                self.branch(o)
-            return
-
         # EMT TRAP IOT BPT
-        if (self.instr & 0o177000) == 0o104000 or self.instr == 3 or self.instr == 4:
+        if (instr & 0o177000) == 0o104000 or instr == 3 or instr == 4:
             #var vec, prev;
-            if (self.instr & 0o177400) == 0o104000:
+            if (instr & 0o177400) == 0o104000:
                 vec = 0o30
-            elif (self.instr & 0o177400) == 0o104400:
+            elif (instr & 0o177400) == 0o104400:
                 vec = 0o34
-            elif self.instr == 3:
+            elif instr == 3:
                 vec = 0o14
             else:
                 vec = 0o20
             prev = self.PS
             self.switchmode(False)
-            self.push(prev)
-            self.push(self.R[7])
-            self.R[7] = self.memory[vec>>1]
+            R[6] -= 2
+            self.write16(R[6], prev)
+            R[6] -= 2
+            self.write16(R[6], R[7])
+            R[7] = self.memory[vec>>1]
             self.PS = self.memory[(vec>>1)+1]
             if self.prevuser:
                 self.PS |= (1<<13) | (1<<12)
             return
 
         # CL?, SE?
-        if (self.instr & 0o177740) == 0o240:
-            if self.instr & 0o20:
-                self.PS |= self.instr & 0o17
+        if (instr & 0o177740) == 0o240:
+            if instr & 0o20:
+                self.PS |= instr & 0o17
             else:
-                self.PS &= ~(self.instr & 0o17)
+                self.PS &= ~(instr & 0o17)
             return
 
         # HALT / WAIT / RTI / RTT / RESET / SETD
-        bits = self.instr
+        bits = instr
         if bits == 0o000000: # HALT
             if not self.curuser:
                 self.writedebug("HALT\n")
                 self.printstate()
                 self.stop_cpu()
-                return
+                raise Suspend()
         elif bits == 0o000001: # WAIT
             #time.sleep(0.001)
             if not self.curuser:
                 self.running.clear()
-                return
+                raise Suspend()
         elif bits == 0o000002 or bits == 0o000006: # RTI / RTT
-            self.R[7] = self.pop()
-            val = self.pop()
+            val = self.read16(R[6])
+            R[6] += 2
+            R[7] = val
+            val = self.read16(R[6])
+            R[6] += 2
             if self.curuser:
                 val &= 0o47
                 val |= self.PS & 0o177730
@@ -1206,36 +1164,54 @@ class PDP11:
             return
         elif bits == 0o170011: # SETD ; not needed by UNIX, but used; therefore ignored
             return
-        raise(Trap(INT.INVAL, "invalid instruction: " + self.disasm(ia)))
+        raise(Trap(INT.INVAL, "invalid instruction {:06o} at {:06o}", instr, ia))
 
 
     def run(self):
-        interrupted_from_wait = False
-        while not self.cpu_stop.is_set():
+        # Bind frequently used attributes to locals: saves a LOAD_ATTR per reference in the loop
+        step = self.step
+        running = self.running
+        interrupts = self.interrupts
+        cpu_stop = self.cpu_stop
+        batch = range(1, PDP11.STEPS_PER_BATCH+1)
+        while not cpu_stop.is_set():
+            # Run a batch of instructions with no per-step bookkeeping; traps, HALT and WAIT end it early
+            done = 0
             try:
-                self.step()
-
-                if not self.running.is_set() and self.clock_running:
-                    self.running.wait()
-                    interrupted_from_wait = True
-
-                # Handle interrupts
-                if (interrupted_from_wait or (self.step_cnt & 0xF) == 0) and not self.interrupts.empty():
-                    priority_level = ((self.PS >> 5) & 7)
-                    if self.last_interrupt_priority > priority_level:
-                        inter = self.interrupts.get()
-                        # this is fixed according to Wikipedia description from >= to >
-                        if inter.pri > priority_level:
-                            self.handleinterrupt(inter.vec)
-                            self.last_interrupt_priority = INT.MAX_PRIORITY
-                        else:
-                            # remember this "unprocessed" interrupt's priority for minor optimization
-                            self.last_interrupt_priority = inter.pri
-                            self.interrupts.put(inter)
-                    interrupted_from_wait = False
-
+                if self.prdebug:
+                    # Single-stepping: keep the counters exact for printstate()
+                    self.iter_cnt += 1
+                    self.step_cnt += 1
+                    step()
+                else:
+                    for done in batch:
+                        step()
             except Trap as e:
-                self.trapat(e.num, str(e))
+                self.trapat(e.num, e)
+            except Suspend:
+                if not running.is_set() and self.clock_running:
+                    running.wait()
+            if done:
+                # Steps executed by this batch, counting the one that ended it early
+                self.iter_cnt += done
+                self.step_cnt += done
+
+            # Handle interrupts
+            if not interrupts.empty():
+                priority_level = ((self.PS >> 5) & 7)
+                if self.last_interrupt_priority > priority_level:
+                    inter = interrupts.get()
+                    # this is fixed according to Wikipedia description from >= to >
+                    if inter.pri > priority_level:
+                        try:
+                            self.handleinterrupt(inter.vec)
+                        except Trap as e:
+                            self.trapat(e.num, e)
+                        self.last_interrupt_priority = INT.MAX_PRIORITY
+                    else:
+                        # remember this "unprocessed" interrupt's priority for minor optimization
+                        self.last_interrupt_priority = inter.pri
+                        interrupts.put(inter)
 
             if self.prdebug:
                 self.printstate()
@@ -6,14 +6,14 @@
 # (c) 2019, Andriy Makukha, ported to Python 3, MIT License
 # Version 6 Unix (in the disk image) is available under the four-clause BSD license.
 
-import time, array, threading
+import sys, array, threading, mmap
 from interrupt import Interrupt
 from unix_v6_fs import UnixV6FileSystem
 
 class System:
     
     def __init__(self):
-        self.memory = array.array('H', bytearray(256*1024*[0]))     # 16-bit unsigned values
+        self.memory = array.array('H', bytearray(256*1024))     # 16-bit unsigned values
         print ('Memory initialized')
 
     def interrupt(self, intr, y):
@@ -42,6 +42,11 @@ class RK05:
     
     def __init__(self, system):
         self.system = system
+        # Register handlers, indexed by word offset from 0o777400
+        self._readers = (self._read_ds, self._read_er, self._read_cs,
+                         self._read_wc, self._read_ba, self._read_da)
+        self._writers = (self._write_ro, self._write_ro, self._write_cs,
+                         self._write_wc, self._write_ba, self._write_da)
         #self.reinit()
     
     def reinit(self):
@@ -53,14 +58,20 @@ class RK05:
         self.sector = 0
         self.surface = 0
         self.cylinder = 0
+        self._pos = 0       # byte offset of the sector under the head
 
         self.reset()
 
     def save_image(self, filename):
-        open(filename, 'wb').write(self.disk)
+        # Copy out first: truncating the file that backs the mapping would invalidate it
+        data = self.disk[:]
+        open(filename, 'wb').write(data)
 
     def load_image(self, filename):
-        self.disk = bytearray(open(filename, 'rb').read())
+        # Private copy-on-write mapping: sectors are paged in on demand and
+        # writes from the emulated machine never reach the image file
+        with open(filename, 'rb') as f:
+            self.disk = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
         if len(self.disk) != RK05.EXPECTED_IMAGE_LENGTH:
             self.system.panic('unexpected image length {} != {}'.format(len(self.disk), RK05.EXPECTED_IMAGE_LENGTH))
         print ('Disk image loaded:', len(self.disk))
@@ -68,7 +79,7 @@ class RK05:
         #max_bytes = 0o313*0o14*2*512        # 4872 blocks, 2494464 bytes
         #if len(self.disk) < max_bytes:
         #    extend_by = max_bytes - len(self.disk)
-        #    self.disk.extend(bytearray(extend_by*[0])) 
+        #    self.disk.extend(bytearray(extend_by)) 
         #    print (' - free space:', extend_by)
 
     def start_sync_thread(self, unix_dir: 'path', local_dir: 'path'):
@@ -106,7 +117,7 @@ class RK05:
             if self.system.terminal.prompt_cnt == 0:
                 self.fs.f.seek(0)
                 disk = self.fs.f.read()
-                if hash(disk_snapshot) != hash(disk) and disk_snapshot != disk:
+                if disk_snapshot != disk:
                     self.disk = bytearray(disk)
                     self.system.writedebug('Disk image replaced with a synced one\n')
 
@@ -129,20 +140,28 @@ class RK05:
         self.DB = 0
 
     def read16(self, a):
-        if a == 0o777400:
-            return self.DS
-        elif a ==0o0777402:
-            return self.ER
-        elif a == 0o0777404:
-            return self.CS | ((self.BA & 0x30000) >> 12)
-        elif a == 0o0777406:
-            return self.WC
-        elif a == 0o0777410:
-            return self.BA & 0xFFFF
-        elif a == 0o0777412:
-            return (self.sector) | (self.surface << 4) | (self.cylinder << 5) | (self.drive << 13)
-        else:
-            self.system.panic('invalid read')
+        i = (a - 0o777400) >> 1
+        if 0 <= i < 6:
+            return self._readers[i]()
+        self.system.panic('invalid read')
+
+    def _read_ds(self):
+        return self.DS
+
+    def _read_er(self):
+        return self.ER
+
+    def _read_cs(self):
+        return self.CS | ((self.BA & 0x30000) >> 12)
+
+    def _read_wc(self):
+        return self.WC
+
+    def _read_ba(self):
+        return self.BA & 0xFFFF
+
+    def _read_da(self):
+        return (self.sector) | (self.surface << 4) | (self.cylinder << 5) | (self.drive << 13)
 
     def notready(self):
         #self.system.event('rkbusy')        # TODO
@@ -169,43 +188,58 @@ class RK05:
         self.system.panic(msg)
 
     def rwsec(self, write):
-        '''Read/write entire sector (512 bytes) to/from memory'''
-        if self.drive != 0: self.error(RK05.RKNXD)
-        if self.cylinder > 0o312: self.error(RK05.RKNXC)
-        if self.sector > 0o13: self.error(RK05.RKNXS)
-        pos = (self.cylinder * 24 + self.surface * 12 + self.sector) * 512
-        for i in range(0, 256):
-            if not self.WC: break
-            if write:
-                # Words are 16-bit
-                val = self.system.memory[self.BA >> 1]
-                self.disk[pos] = val & 0xFF
-                self.disk[pos+1] = (val >> 8) & 0xFF
-            else:
-                self.system.memory[self.BA >> 1] = self.disk[pos] | (self.disk[pos+1] << 8)
-            self.BA += 2
-            self.WC = (self.WC + 1) & 0xFFFF
-            pos += 2
-
-        # Check for overflow
-        self.sector += 1
-        if self.sector > 0o13:
-            self.sector = 0
-            self.surface += 1
-            if self.surface > 1:
-                self.surface = 0
-                self.cylinder += 1
-                if self.cylinder > 0o312:
+        '''Read/write sectors (512 bytes each) to/from memory until the word count runs out'''
+        mem = self.system.memory
+        swap = sys.byteorder != 'little'       # disk words are little-endian
+        while True:
+            if self.drive != 0: self.error(RK05.RKNXD)
+            if self.cylinder > 0o312: self.error(RK05.RKNXC)
+            if self.sector > 0o13: self.error(RK05.RKNXS)
+            pos = self._pos
+            if self.WC:
+                # WC holds the negated word count; copy up to a sector in one slice
+                cnt = min(0x10000 - self.WC, 256)
+                w = self.BA >> 1
+                # Short slices would silently resize the memory array or the disk image
+                if w + cnt > len(mem):
+                    self.system.panic('disk transfer beyond the end of memory')
+                    return
+                if pos + 2*cnt > len(self.disk):
                     self.error(RK05.RKOVR)
+                    return
+                if write:
+                    words = mem[w:w+cnt]
+                    if swap: words.byteswap()
+                    self.disk[pos:pos+2*cnt] = words.tobytes()
+                else:
+                    words = array.array('H', self.disk[pos:pos+2*cnt])
+                    if swap: words.byteswap()
+                    mem[w:w+cnt] = words
+                self.BA += 2*cnt
+                self.WC = (self.WC + cnt) & 0xFFFF
+
+            # Check for overflow
+            self.sector += 1
+            self._pos = pos + 512
+            if self.sector > 0o13:
+                self.sector = 0
+                self.surface += 1
+                if self.surface > 1:
+                    self.surface = 0
+                    self.cylinder += 1
+                    if self.cylinder > 0o312:
+                        self.error(RK05.RKOVR)
+                        return
+                self._pos = (self.cylinder * 24 + self.surface * 12) * 512
+
+            #setTimeout('rkrwsec('+t+')', 3);
+            #time.sleep(0.003)      # seems unnecessary
+            if not self.WC:
+                break
 
-        if self.WC:
-                #setTimeout('rkrwsec('+t+')', 3);
-                #time.sleep(0.003)      # seems unnecessary
-                self.rwsec(write)
-        else:
-                self.ready()
-                if self.CS & (1<<6):
-                     self.system.interrupt(Interrupt.RK, 5)
+        self.ready()
+        if self.CS & (1<<6):
+             self.system.interrupt(Interrupt.RK, 5)
 
     def go(self):
         op = (self.CS & 0xF) >> 1
@@ -214,39 +248,48 @@ class RK05:
             self.reset()
         elif op == 1:
             self.notready()
-            #setTimeout('rkrwsec(true)', 3)
-            time.sleep(0.003)           # TODO: do we need it?
+            #setTimeout('rkrwsec(true)', 3)    # the transfer completes synchronously instead
             self.rwsec(True)
         elif op == 2:
             self.notready()
-            #setTimeout('rkrwsec(false)', 3)
-            time.sleep(0.003)           # TODO: do we need it?
+            #setTimeout('rkrwsec(false)', 3)   # the transfer completes synchronously instead
             self.rwsec(False)
         else:
             self.system.panic('unimplemented RK05 operation 0x{:x}'.format(op))
 
     def write16(self, a, v):
-        if a in [0o777400, 0o777402]: return
-        elif a == 0o777404:
-            self.BA = (self.BA & 0xFFFF) | ((v & 0o60) << 12)
-            v &= 0o17517       # writable bits
-            self.CS &= ~0o17517
-            self.CS |= v & ~1  # dont set GO bit
-            if v & 1:
-                self.go()
-        elif a == 0o777406:
-            self.WC = v
-        elif a == 0o777410:
-            self.BA = (self.BA & 0x30000) | v
-        elif a == 0o777412:
-            self.drive = v >> 13
-            self.cylinder = (v >> 5) & 0o377
-            self.surface = (v >> 4) & 1
-            self.sector = v & 15
+        i = (a - 0o777400) >> 1
+        if 0 <= i < 6:
+            self._writers[i](v)
         else:
             self.system.panic('invalid write')
 
+    def _write_ro(self, v):
+        # DS and ER are read-only
+        pass
+
+    def _write_cs(self, v):
+        self.BA = (self.BA & 0xFFFF) | ((v & 0o60) << 12)
+        v &= 0o17517       # writable bits
+        self.CS &= ~0o17517
+        self.CS |= v & ~1  # dont set GO bit
+        if v & 1:
+            self.go()
+
+    def _write_wc(self, v):
+        self.WC = v
+
+    def _write_ba(self, v):
+        self.BA = (self.BA & 0x30000) | v
+
+    def _write_da(self, v):
+        self.drive = v >> 13
+        self.cylinder = (v >> 5) & 0o377
+        self.surface = (v >> 4) & 1
+        self.sector = v & 15
+        self._pos = (self.cylinder * 24 + self.surface * 12 + self.sector) * 512
+
 if __name__=='__main__':
-    sys = System()
-    rk05 = RK05(sys)
+    system = System()
+    rk05 = RK05(system)
 
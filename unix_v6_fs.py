@@ -5,7 +5,9 @@
 #     https://github.com/amakukha/PyPDP11
 # Copyright (c) 2019, Andriy Makukha, MIT Licence
 
-import struct, os, array, time, datetime, io, string, threading, base64
+import struct, os, array, time, datetime, string, threading, base64, mmap
+from operator import itemgetter
+from itertools import compress
 
 localjoin = os.path.join
 def unixjoin(head, *args):
@@ -20,6 +22,12 @@ BLOCK_SIZE = 512
 INODE_SIZE = 32
 BIGGEST_NOT_HUGE_SIZE = BLOCK_SIZE*BLOCK_SIZE/2*8
 
+# On-disk layouts (PDP-11 is little-endian, no padding)
+INODE_STRUCT = struct.Struct('<HBBBBHHHHHHHHHHHHH')
+DIRENT_STRUCT = struct.Struct('<H14s')
+SUPERBLOCK_STRUCT = struct.Struct('<HHH100HH100HBBBI')   # isize, fsize, nfree, free[100], ninode, inode[100], flock, ilock, fmod, time
+U16_STRUCT = struct.Struct('<H')
+
 # Higher bytes of file modtime used by PyPDP11 for syncing and creating
 CREATED_BY_PYPDP11 = 0x17000000         # all within 1982 Summer time (EDT)
 SYNCED_BY_PYPDP11  = 0x19000000         # all within 1983 Summer time (EDT)
@@ -29,6 +37,18 @@ TIME_DELTA = 60
 TIME_ERROR_S = 47                       # it's unclear why the difference appears to be 47 on my machine TODO
 TIME_ZONE_OFFSET = 14400
 
+# Permission bits (owner, group, others) as strings like 'RWXR.XR.X', indexed by the low 9 bits of a flag word
+PERMISSION_STRINGS = [''.join('RWX'[i % 3] if p & (0o400 >> i) else '.' for i in range(9)) for p in range(0o1000)]
+# Flag word strings already built by INode.flags_string, by flag word
+FLAGS_STRINGS = {}
+
+# Bytes with the highest bit set (sign-extended by `sum`)
+HIGH_BYTES = bytes(range(0x80, 0x100))
+
+# Translation tables from the high byte of an inode flag word to 1 if the inode is allocated (free), else 0
+ALLOCATED_BIT = bytes(b >> 7 for b in range(0x100))
+FREE_BIT = bytes(1 - (b >> 7) for b in range(0x100))
+
 # TODO:
 # - check that all the non-free nodes (according to the chain) are actually used 
 # - check that all the allocated nodes (files) belong to some parent directory
@@ -39,6 +59,13 @@ class HugeFileError(ValueError):
 class SyncError(ValueError):
     pass
 
+def nonzero_prefix(words: array.array) -> array.array:
+    '''Block numbers up to the first zero, which terminates a block list'''
+    try:
+        return words[:words.index(0)]
+    except ValueError:
+        return words
+
 class Superblock:
     def __init__(self, *args):
         if type(args[0])!=bytes:
@@ -49,21 +76,17 @@ class Superblock:
 
     def parse(self, data):
         # According to Unix V6 /usr/man/man5/fs.5
-        self.isize, self.fsize, self.nfree = struct.unpack('HHH', data[:6])
-        self.free = array.array('H', data[6:206])
-        self.ninode = struct.unpack('H', data[206:208])[0]
-        self.inode = array.array('H', data[208:408])
-        self.flock, self.ilock, self.fmod = struct.unpack('BBB', data[408:411])
-        self.time = struct.unpack('I', data[411:415])[0]
+        vals = SUPERBLOCK_STRUCT.unpack_from(data)
+        self.isize, self.fsize, self.nfree = vals[:3]
+        self.free = array.array('H', vals[3:103])
+        self.ninode = vals[103]
+        self.inode = array.array('H', vals[104:204])
+        self.flock, self.ilock, self.fmod, self.time = vals[204:]
 
     def serialize(self):
-        data  = struct.pack('HHH', self.isize, self.fsize, self.nfree)
-        data += self.free.tobytes()
-        data += struct.pack('H', self.ninode)
-        data += self.inode.tobytes()
-        data += struct.pack('BBB', self.flock, self.ilock, self.fmod)
-        data += struct.pack('I', self.time)
-        return data
+        return SUPERBLOCK_STRUCT.pack(self.isize, self.fsize, self.nfree, *self.free,
+                                      self.ninode, *self.inode,
+                                      self.flock, self.ilock, self.fmod, self.time)
 
     def __repr__(self):
         return 'Superblock(isize={isize},fsize={fsize},nfree={nfree},ninode={ninode})'.format(
@@ -71,6 +94,8 @@ class Superblock:
                 )
 
 class INode:
+    __slots__ = ('inode', 'flag', 'nlinks', 'uid', 'gid', 'size', 'addr', 'actime', 'modtime')
+
     def __init__(self, *args):
         self.inode = 0
         if len(args)==18:
@@ -81,7 +106,7 @@ class INode:
                 data = args[0].read(INODE_SIZE)
             else:
                 data = args[0]
-            params = struct.unpack('HBBBBHHHHHHHHHHHHH', data)
+            params = INODE_STRUCT.unpack(data)
             self.setup(*params)
         else:
             self.setup(*([0]*18))
@@ -97,16 +122,14 @@ class INode:
         self.uid = args[2]              # byte: user ID of owner
         self.gid = args[3]              # byte: group ID of owner
         self.size = (args[4]<<16) + args[5]   # byte + short
-        self.addr = list(args[6:14])    # uint16_t[8]: device addresses constituting file
+        self.addr = array.array('H', args[6:14])     # uint16_t[8]: device addresses constituting file
         self.actime = (args[14] << 16) | args[15]  # time of last access 
         self.modtime = (args[16] << 16) | args[17] # time of last modification
 
     def serialize(self):
-        data = struct.pack('HBBBBH', self.flag, self.nlinks, self.uid, self.gid, self.size>>16, self.size & 0xFFFF)
-        for i in range(8):
-            data += struct.pack('H', self.addr[i])
-        data += struct.pack('HHHH', self.actime >> 16, self.actime & 0xFFFF, self.modtime >> 16, self.modtime & 0xFFFF)
-        return data
+        return INODE_STRUCT.pack(self.flag, self.nlinks, self.uid, self.gid, self.size >> 16, self.size & 0xFFFF,
+                                 *self.addr,
+                                 self.actime >> 16, self.actime & 0xFFFF, self.modtime >> 16, self.modtime & 0xFFFF)
 
     def set_free(self):                 # disallocate, mark inode as free
         self.flag &= 0x7FFF
@@ -137,22 +160,12 @@ class INode:
 
     def flags_string(self):
         '''Represent the flag word as a string'''
-        s = ''
-        s += 'a' if self.flag & 0x8000 else '.'
-        fmt = (self.flag & 0x6000) >> 13
-        s += {0: 'F', 1: 'S', 2: 'D', 3: 'B'}[fmt]
-        s += 'L' if self.flag & 0x1000 else '.'
-        s += 'U' if self.flag & 0x0800 else '.'
-        s += 'G' if self.flag & 0x0400 else '.'
-        s += 'R' if self.flag & 0x0100 else '.'
-        s += 'W' if self.flag & 0x0080 else '.'
-        s += 'X' if self.flag & 0x0040 else '.'
-        s += 'R' if self.flag & 0x0020 else '.'
-        s += 'W' if self.flag & 0x0010 else '.'
-        s += 'X' if self.flag & 0x0008 else '.'
-        s += 'R' if self.flag & 0x0004 else '.'
-        s += 'W' if self.flag & 0x0002 else '.'
-        s += 'X' if self.flag & 0x0001 else '.'
+        f = self.flag
+        s = FLAGS_STRINGS.get(f)
+        if s is None:
+            s = FLAGS_STRINGS[f] = ('a' if f & 0x8000 else '.') + 'FSDB'[(f & 0x6000) >> 13] + \
+                                   ('L' if f & 0x1000 else '.') + ('U' if f & 0x0800 else '.') + \
+                                   ('G' if f & 0x0400 else '.') + PERMISSION_STRINGS[f & 0x01FF]
         return s
 
     def __lt__(self, other):
@@ -160,7 +173,7 @@ class INode:
 
     def __repr__(self):
         return 'INode(uid={uid},gid={gid},addrs={addr},size={size},flags={flags})'.format(
-                    uid=self.uid, gid=self.gid, addr=str(self.addr), size=self.size,
+                    uid=self.uid, gid=self.gid, addr=str(self.addr.tolist()), size=self.size,
                     flags=self.flags_string(),
                 )
 
@@ -168,37 +181,80 @@ class UnixV6FileSystem:
     def __init__(self, arg: str or bytes):
         if isinstance(arg, str):
             # Filename assumed
-            self.f = open(arg, 'r+b')
+            with open(arg, 'r+b') as f:
+                self.f = mmap.mmap(f.fileno(), 0)
         elif isinstance(arg, bytes):
             # Actual data assumed
-            self.f = io.BytesIO(arg)
+            self.f = mmap.mmap(-1, len(arg))
+            self.f[:] = arg
+        # The mmap is both file-like and sliceable: blocks and inodes are accessed by slicing
+        self.mv = memoryview(self.f)
+        self._inodes = {}           # parsed inodes by number; kept in step by write_i_node
+        self._sup = None            # parsed superblock; kept in step by write_superblock
+        self._dirs = {}             # directory listings by inode number; dropped by write_i_node
 
     def read_superblock(self):
-        self.f.seek(BLOCK_SIZE)
-        sup = Superblock(self.f)
-        return sup
+        if self._sup is None:
+            self._sup = Superblock(self.f[BLOCK_SIZE:BLOCK_SIZE+SUPERBLOCK_SIZE])
+        return self._sup
 
     def write_block(self, blkn: int, data: bytes):
         if len(data) > BLOCK_SIZE:
             raise ValueError('data is too big to fit into one block')
-        data += b'\x00' * (BLOCK_SIZE - len(data)) 
-        self.f.seek(BLOCK_SIZE*blkn)
-        self.f.write(data)
+        pos = BLOCK_SIZE*blkn
+        end = pos + len(data)
+        self.f[pos:end] = data
+        if len(data) < BLOCK_SIZE:
+            self.f[end:pos+BLOCK_SIZE] = bytes(BLOCK_SIZE - len(data))     # zero the rest of the block
+
+    def write_blocks(self, blocks: [int], data: bytes):
+        '''Write data over the listed blocks in order, with one copy per run of consecutive block numbers'''
+        data = memoryview(data)
+        f = self.f
+        n = len(blocks)
+        i = 0
+        while i < n:
+            j = i + 1
+            while j < n and blocks[j] == blocks[j-1] + 1:
+                j += 1
+            pos = BLOCK_SIZE*blocks[i]
+            chunk = data[BLOCK_SIZE*i:BLOCK_SIZE*j]
+            end = pos + len(chunk)
+            f[pos:end] = chunk
+            run_end = pos + BLOCK_SIZE*(j-i)
+            if end < run_end:
+                f[end:run_end] = bytes(run_end - end)
+            i = j
 
     def write_superblock(self, sup: Superblock):
         data = sup.serialize()
         self.write_block(1, data)
+        self._sup = sup
 
     def read_i_node(self, i: int):
-        self.f.seek(BLOCK_SIZE*2 + (i-1)*32)
-        node = INode(self.f)
-        node.inode = i          # remember its number for convenience
+        node = self._inodes.get(i)
+        if node is None:
+            node = INode(*INODE_STRUCT.unpack_from(self.f, BLOCK_SIZE*2 + (i-1)*INODE_SIZE))
+            node.inode = i          # remember its number for convenience
+            self._inodes[i] = node
         return node
 
+    def list_i_nodes(self, sup: Superblock=None, allocated=True) -> [int]:
+        '''Return numbers of all the allocated (or free) inodes, scanning the flags in the inode table at once'''
+        if sup is None:
+            sup = self.read_superblock()
+        icnt = sup.isize*BLOCK_SIZE//INODE_SIZE
+        # High byte of every flag word, mapped to 1 where the inode matches
+        table = self.f[BLOCK_SIZE*2:BLOCK_SIZE*(2+sup.isize)]
+        mask = table[1::INODE_SIZE].translate(ALLOCATED_BIT if allocated else FREE_BIT)
+        return list(compress(range(1, icnt+1), mask))
+
     def write_i_node(self, node: INode):
         data = node.serialize()
-        self.f.seek(BLOCK_SIZE*2 + (node.inode-1)*32)
-        self.f.write(data)
+        pos = BLOCK_SIZE*2 + (node.inode-1)*32
+        self.f[pos:pos+INODE_SIZE] = data
+        self._inodes[node.inode] = node
+        self._dirs.pop(node.inode, None)    # directory contents change together with its inode
 
     def ensure_i_node(self, x: INode or int):
         if isinstance(x, INode):
@@ -210,35 +266,44 @@ class UnixV6FileSystem:
         return inode.flags_string()
 
     def read_block(self, blkn: int):
-        self.f.seek(BLOCK_SIZE*blkn)
-        data = self.f.read(BLOCK_SIZE)
-        return data
+        return self.f[BLOCK_SIZE*blkn:BLOCK_SIZE*(blkn+1)]
 
     def yield_node_blocks(self, node: INode or int, include_all=False) -> int:
         node = self.ensure_i_node(node)
         if node.size > BIGGEST_NOT_HUGE_SIZE:
             raise HugeFileError('huge files not implemented')
         if not node.is_large():
-            for n in node.addr:
-                if n == 0: return
-                yield n
+            yield from nonzero_prefix(node.addr)
         else:
             for blk in node.addr:
                 if not blk: return
                 if include_all:
                     yield blk
-                indirect_block = self.read_block(blk)
-                for i in range(0, len(indirect_block), 2):
-                    n = struct.unpack('H', indirect_block[i:i+2])[0]
-                    if n == 0: return
-                    yield n
+                ptrs = nonzero_prefix(array.array('H', self.read_block(blk)))
+                yield from ptrs
+                if len(ptrs) < BLOCK_SIZE//2: return       # list ended inside this block
 
-    def read_file(self, node: INode or int):
+    def yield_file_data(self, node: INode or int) -> memoryview:
+        '''Yield zero-copy views of the file's data, one per run of consecutive blocks,
+        the last one trimmed to the file size'''
         node = self.ensure_i_node(node)
-        contents = b''
+        left = node.size
+        start = length = 0
         for n in self.yield_node_blocks(node):
-            contents += self.read_block(n)
-        return contents[:node.size]
+            if left <= 0: break
+            size = min(left, BLOCK_SIZE)
+            left -= size
+            if length and BLOCK_SIZE*n == start + length:
+                length += size          # continues the current run
+                continue
+            if length:
+                yield self.mv[start:start+length]
+            start, length = BLOCK_SIZE*n, size
+        if length:
+            yield self.mv[start:start+length]
+
+    def read_file(self, node: INode or int):
+        return b''.join(self.yield_file_data(node))        # the only copy of the data
         
     def sum_file(self, x: bytes or INode or int):
         '''
@@ -251,46 +316,52 @@ class UnixV6FileSystem:
             data = x
         else:
             data = self.read_file(x)
-        s = 0
-        for c in data:
-            s += c if c <= 0x7F else (c | 0xFF00)
-            if s>0xFFFF:    # 16-bit overflow
-                s = (s+1) & 0xFFFF
-        return s
+        # Bytes are sign-extended to 16 bits (c | 0xFF00 for c > 0x7F) and added
+        # with end-around carry, i.e. modulo 0xFFFF where a non-zero total never
+        # folds to zero. So the whole sum can be computed at once.
+        high = len(data) - len(data.translate(None, HIGH_BYTES))
+        s = sum(data) + 0xFF00*high
+        return (s-1) % 0xFFFF + 1 if s else 0
 
     def list_dir(self, dnode: INode or int) -> [(int, str)]:
         inode = self.ensure_i_node(dnode)
         # Read & interpret file
         if not inode.is_dir():
             return None
+        files = self._dirs.get(inode.inode)
+        if files is not None:
+            return list(files)
         files = []
-        data = self.read_file(inode)
-        for i in range(0, len(data), 16):
-            inum, name = struct.unpack('H14s', data[i:i+16])
-            if inum > 0:
-                try:
-                    name = name.decode().rstrip('\x00')
-                except Exception as e:
-                    print('ERROR: could not decode filename:',repr(name))
-                    raise e
-                files.append((inum, name))
-        return files
+        for data in self.yield_file_data(inode):
+            for inum, name in DIRENT_STRUCT.iter_unpack(data):
+                if inum > 0:
+                    try:
+                        name = name.decode().rstrip('\x00')
+                    except Exception as e:
+                        print('ERROR: could not decode filename:',repr(name))
+                        raise e
+                    files.append((inum, name))
+        self._dirs[inode.inode] = files
+        return list(files)
 
     def path_i_node(self, path, node=1):
         if path and path[0]=='/':
-            return self.path_i_node(path.strip('/'))       # root directory, we already know the inode (1)
-        #print(path, node)
-        inode = self.read_i_node(node)
-        if not path:
-            if inode.is_allocated():
-                inode.inode = node
-                return inode
-            return None
-        if inode.is_dir(): 
-            name, tail = path.split('/', 1) if '/' in path else (path, '')
+            node = 1            # root directory, we already know the inode (1)
+        for name in path.split('/'):
+            if not name: continue
+            inode = self.read_i_node(node)
+            if not inode.is_dir():
+                return None
             for no, nm in self.list_dir(inode):
-                if nm != name: continue
-                return self.path_i_node(tail, no)
+                if nm == name:
+                    node = no
+                    break
+            else:
+                return None
+        inode = self.read_i_node(node)
+        if inode.is_allocated():
+            inode.inode = node
+            return inode
         return None
     
     def start_sync_thread(self, unix_dir: 'path', local_dir: 'path', terminal):
@@ -406,53 +477,42 @@ class UnixV6FileSystem:
 
         ui = li = cnt = 0
         sync_subdirs = []
-        while ui < len(ufs) and li < len(lfs):
-            if ufs[ui][0] == lfs[li][0]:        # same name
-                if ufs[ui][2] == lfs[li][2]:    # same type
-                    if ufs[ui][2]:
-                        sync_subdirs.append((ufs[ui][1], lfs[li][1]))
+        nu, nl = len(ufs), len(lfs)
+        while ui < nu or li < nl:
+            ufile = ufs[ui] if ui < nu else None
+            lfile = lfs[li] if li < nl else None
+            if ufile is not None and lfile is not None and ufile[0] == lfile[0]:  # same name
+                if ufile[2] == lfile[2]:        # same type
+                    if ufile[2]:
+                        sync_subdirs.append((ufile[1], lfile[1]))
                     else:
                         # COMPARE FILES
-                        umtime = ufs[ui][3].modtime                     #  Unix modtime
-                        lmtime = int(os.stat(lfs[li][1]).st_mtime)      # local modtime
+                        umtime = ufile[3].modtime                   #  Unix modtime
+                        lmtime = int(os.stat(lfile[1]).st_mtime)    # local modtime
                         if (umtime & 0xFF000000) not in [CREATED_BY_PYPDP11, SYNCED_BY_PYPDP11]:
-                            download(ufs[ui], local_dir)
+                            download(ufile, local_dir)
                         elif abs((umtime & 0xFFFFFF) - (lmtime & 0xFFFFFF) + TIME_ERROR_S)>TIME_DELTA:
                             print('Time difference {}'.format((umtime & 0xFFFFFF) - (lmtime & 0xFFFFFF)))
-                            upload(lfs[li], unix_dir)
+                            upload(lfile, unix_dir)
                 else:
-                    raise SyncError('type mismatch: {} and {}'.format(ufs[ui][1], lfs[li][1]))
+                    raise SyncError('type mismatch: {} and {}'.format(ufile[1], lfile[1]))
                 ui += 1;  li += 1
-            elif ufs[ui][0] < lfs[li][0]:
-                if ufs[ui][2]:
-                    sync_subdirs.append((ufs[ui][1], localjoin(local_dir, ufs[ui][0])))
+            elif lfile is None or (ufile is not None and ufile[0] < lfile[0]):
+                # Only on the Unix side
+                if ufile[2]:
+                    sync_subdirs.append((ufile[1], localjoin(local_dir, ufile[0])))
                 else:
-                    download(ufs[ui], local_dir)
+                    download(ufile, local_dir)
                 ui += 1
             else:
-                if lfs[li][2]:
-                    sync_subdirs.append((unixjoin(unix_dir, lfs[li][0]), lfs[li][1]))
+                # Only on the local side
+                if lfile[2]:
+                    sync_subdirs.append((unixjoin(unix_dir, lfile[0]), lfile[1]))
                 else:
-                    upload(lfs[li], unix_dir) 
+                    upload(lfile, unix_dir)
                 li += 1
             cnt += 1
 
-        # TODO: repeating code, DRY it
-        while ui < len(ufs):
-            if ufs[ui][2]:
-                sync_subdirs.append((ufs[ui][1], localjoin(local_dir, ufs[ui][0])))
-            else:
-                download(ufs[ui], local_dir)
-            ui += 1
-            cnt += 1
-        while li < len(lfs):
-            if lfs[li][2]:
-                sync_subdirs.append((unixjoin(unix_dir, lfs[li][0]), lfs[li][1]))
-            else:
-                upload(lfs[li], unix_dir)
-            li += 1
-            cnt += 1
-
         # Sync subfolders recursively
         for udir, ldir in sync_subdirs:
             cnt, via_comm = self.sync(udir, ldir, terminal, root=False)
@@ -472,19 +532,18 @@ class UnixV6FileSystem:
         Call it like `fs.tree(1)` to descend into the root directory (first inode).
         Returns size of all files, as well as number of occupied blocks.
         '''
-        dir_node = fs.read_i_node(inum)
-        data = fs.list_dir(dir_node)
+        dir_node = self.read_i_node(inum)
+        data = self.list_dir(dir_node)
         if data is None:
             return
-        data.sort(key = lambda x: x[1])
-        last_inum, last_name = 0, ''
+        seen = set()
+        data = [e for e in data if not (e in seen or seen.add(e))]     # drop repeated entries
+        data.sort(key = itemgetter(1))
         size, blk_size = 0, 0
         for inum, name in data:
-            if (last_inum, last_name) == (inum, name):
-                continue
             print(' '*tabs,end='')
             node = self.read_i_node(inum)
-            contents = self.read_file(inum)
+            contents = self.read_file(node)
             if not node.is_dir() and save_path is not None:
                 filepath = localjoin(save_path, name)
                 open(filepath, 'wb').write(contents)
@@ -508,7 +567,6 @@ class UnixV6FileSystem:
                     sz, blk_sz = self.tree(inum, dirpath, tabs + 4)
                 size += sz
                 blk_size += blk_sz
-            last_inum, last_name = inum, name
         return size, blk_size
 
     def extract_dir(self, dst_dirname, src_dirname='/'):
@@ -527,12 +585,10 @@ class UnixV6FileSystem:
         sup = self.read_superblock()
         if sup.ninode <= 0:
             sup.ninode = 0
-            # Find free inodes
-            for i in range(1, sup.isize*BLOCK_SIZE//INODE_SIZE+1):
-                node = self.read_i_node(i)
-                if not node.is_allocated():
-                    sup.inode[sup.ninode] = i
-                    sup.ninode += 1
+            # Find free inodes (the superblock list holds at most 100)
+            for i in self.list_i_nodes(sup, allocated=False)[:len(sup.inode)]:
+                sup.inode[sup.ninode] = i
+                sup.ninode += 1
         if sup.ninode > 0:
             sup.ninode -= 1
             inode = sup.inode[sup.ninode]
@@ -544,45 +600,56 @@ class UnixV6FileSystem:
         else:
             raise Exception("no free inodes")
 
-    def free_i_node(self, inode):
+    def free_i_node(self, inode: INode or int):
+        node = self.ensure_i_node(inode)
         sup = self.read_superblock()
         if sup.ninode<100:
-            sup.inode[sup.ninode] = inode
+            sup.inode[sup.ninode] = node.inode
             sup.ninode += 1
             self.write_superblock(sup)
         # "the information as to whether the inode is really free or not is maintained in the inode itself"
-        node = self.ensure_i_node(inode)
         node.set_free()
         self.write_i_node(node)
 
     def allocate_block(self):
         # Returns block number
+        return self.allocate_blocks(1)[0]
+
+    def allocate_blocks(self, n: int) -> [int]:
+        '''Allocate n blocks in the same order as n calls to allocate_block would,
+        but write the superblock only once'''
         sup = self.read_superblock()
-        sup.nfree -= 1
-        blkn = sup.free[sup.nfree]
-        if sup.nfree>0:
+        blocks = []
+        try:
+            while len(blocks) < n:
+                sup.nfree -= 1
+                blkn = sup.free[sup.nfree]
+                if sup.nfree>0:
+                    if blkn == 0:
+                        raise ValueError('allocated free block number is zero')
+                else:
+                    # Retrieve block from the chain
+                    blk = self.read_block(blkn)
+                    sup.nfree, = U16_STRUCT.unpack_from(blk, 0)
+                    sup.free = array.array('H', blk[2:202])
+                blocks.append(blkn)
+        finally:
             self.write_superblock(sup)
-            if blkn == 0:
-                raise ValueError('allocated free block number is zero')
-            return blkn
-        # Retrieve block from the chain
-        blk = self.read_block(blkn)
-        sup.nfree = struct.unpack('H', blk[:2])[0]
-        for i in range(100):
-            sup.free[i] = struct.unpack('H', blk[2+2*i:4+2*i])[0]
-        self.write_superblock(sup)
-        return blkn
+        return blocks
 
     def free_block(self, blkn):
+        self.free_blocks([blkn])
+
+    def free_blocks(self, blocks: [int]):
+        '''Free the blocks in order, writing the superblock only once'''
         sup = self.read_superblock()
-        if sup.nfree >= 100:
-            data = struct.pack('H', sup.nfree)
-            for i in range(100):
-                data += struct.pack('H', sup.free[i])
-            self.write_block(blkn, data)
-            sup.nfree = 0
-        sup.free[sup.nfree] = blkn
-        sup.nfree += 1
+        for blkn in blocks:
+            if sup.nfree >= 100:
+                data = U16_STRUCT.pack(sup.nfree) + sup.free.tobytes()
+                self.write_block(blkn, data)
+                sup.nfree = 0
+            sup.free[sup.nfree] = blkn
+            sup.nfree += 1
         self.write_superblock(sup)
             
 
@@ -603,10 +670,9 @@ class UnixV6FileSystem:
         block = self.allocate_block()
         
         # Write block
-        data  = struct.pack('H', node.inode)
-        data += b'.' + b'\x00'*13
-        data += struct.pack('H', pnode.inode)
-        data += b'..' + b'\x00'*12
+        data = bytearray(2*DIRENT_STRUCT.size)
+        DIRENT_STRUCT.pack_into(data, 0, node.inode, b'.')
+        DIRENT_STRUCT.pack_into(data, DIRENT_STRUCT.size, pnode.inode, b'..')
         self.write_block(block, data)
 
         # Write inode
@@ -635,9 +701,7 @@ class UnixV6FileSystem:
         block = self.read_block(dnode.addr[i])[:blksz]
         
         # Add record to directory blocks
-        block += struct.pack('H', fnode.inode)
-        name = name[:14]
-        block += name.encode() + b'\x00'*(14-len(name))
+        block += DIRENT_STRUCT.pack(fnode.inode, name[:14].encode())      # name is zero-padded
         self.write_block(dnode.addr[i], block)
 
         # Update directory size
@@ -767,102 +831,93 @@ class UnixV6FileSystem:
 
         # Free all the occupied blocks
         if fnode.size > 0:
-            for blkn in self.yield_node_blocks(fnode,include_all=True):
-                self.free_block(blkn)
+            # Collect first: freeing may overwrite an indirect block with the free chain
+            self.free_blocks(list(self.yield_node_blocks(fnode,include_all=True)))
 
         # New size
         fnode.size = len(contents)
-        fnode.addr = [0]*8
+        fnode.addr = array.array('H', bytes(16))
         
         # Allocate and write blocks
         last_block = (fnode.size-1)//BLOCK_SIZE
         if len(contents) <= BLOCK_SIZE*8:
             # Small file
             fnode.clear_large()
-            for i in range(last_block+1):
-                blkn = self.allocate_block()
-                fnode.addr[i] = blkn
-                if i!=last_block:
-                    self.write_block(blkn, contents[i*BLOCK_SIZE:(i+1)*BLOCK_SIZE])
-                else:
-                    self.write_block(blkn, contents[i*BLOCK_SIZE:])
+            blocks = self.allocate_blocks(last_block+1)
+            fnode.addr[:len(blocks)] = array.array('H', blocks)
         else:
             # Large file (but not huge)
             fnode.set_large()
-            blkcnt = 0
-            for a in range(8):
-                ablkn = self.allocate_block()
-                ablkdata = b''
+            # Each indirect block is allocated right before the (up to) 256 data blocks it lists
+            nind = last_block//256 + 1
+            allocated = self.allocate_blocks(last_block+1 + nind)
+            blocks = []
+            for a in range(nind):
+                ablkn = allocated[a*257]
+                ablkdata = allocated[a*257+1:(a+1)*257]
                 fnode.addr[a] = ablkn
-                for b in range(256):
-                    blkn = self.allocate_block()
-                    ablkdata += struct.pack('H', blkn)
-                    if blkcnt!=last_block:
-                        self.write_block(blkn, contents[blkcnt*BLOCK_SIZE:(blkcnt+1)*BLOCK_SIZE])
-                    else:
-                        self.write_block(blkn, contents[blkcnt*BLOCK_SIZE:])
-                        break
-                    blkcnt += 1
-                self.write_block(ablkn, ablkdata)
-                if blkcnt==last_block:
-                    break
+                self.write_block(ablkn, array.array('H', ablkdata).tobytes())
+                blocks += ablkdata
+        self.write_blocks(blocks, contents)
 
         # Write inode
         self.write_i_node(fnode)
 
-    def get_free_blocks(self):
-        '''Return list of all free block numbers'''
+    def get_free_blocks(self, verbose=True):
+        '''Return list of all free block numbers; with verbose, report problems found in the free chain'''
         sup = self.read_superblock()
         free = sup.nfree
         free_blks = []
+        seen = set()
+        report = []
         for blkn in sup.free[:sup.nfree]:
             if blkn:
-                if blkn in free_blks:
-                    print('error: 0 block {} repeated'.format(blkn))
+                if blkn in seen:
+                    report.append('error: 0 block {} repeated'.format(blkn))
                 free_blks.append(blkn)
+                seen.add(blkn)
             else:
-                print('error:zero blk')
+                report.append('error:zero blk')
         chlen = 0
         next_block = sup.free[0]
         while next_block:
             chlen += 1
-            blk = self.read_block(next_block)
-            fr = struct.unpack('H', blk[:2])[0]
+            words = array.array('H', self.read_block(next_block))
+            fr = words[0]
             if not fr:
-                print('abnormal')
+                report.append('abnormal')
                 break
             free += fr
-            next_block = struct.unpack('H', blk[2:4])[0]
-            for i in range(fr):
-                blkn = struct.unpack('H', blk[2+i*2:4+i*2])[0]
+            next_block = words[1]
+            for i, blkn in enumerate(words[1:1+fr]):
                 if blkn:
-                    if blkn in free_blks:
-                        print('error: {} block {} repeated'.format(chlen, blkn))
+                    if blkn in seen:
+                        report.append('error: {} block {} repeated'.format(chlen, blkn))
                     free_blks.append(blkn)
+                    seen.add(blkn)
                 elif next_block or i!=0:
-                    print('error: zero blk @', len(free_blks))
-        print('chain length:', chlen)
-        if len(set(free_blks))!=len(free_blks):
-            print('error: free blocks are repeated: {} / {}'.format(len(set(free_blks)), len(free_blks)))
+                    report.append('error: zero blk @ {}'.format(len(free_blks)))
+        report.append('chain length: {}'.format(chlen))
+        if len(seen)!=len(free_blks):
+            report.append('error: free blocks are repeated: {} / {}'.format(len(seen), len(free_blks)))
+        if verbose:
+            print('\n'.join(report))
         return free_blks
 
     def get_used_blocks(self):
-        blks = set()
+        used = bytearray(0x10000)       # one flag per possible (16-bit) block number
         for node in self.yield_all_inodes():
             for blk in self.yield_node_blocks(node, include_all=True):
-                blks.add(blk)
-        return list(blks)
+                used[blk] = 1
+        return list(compress(range(len(used)), used))
 
     def yield_all_inodes(self):
         sup = self.read_superblock()
         icnt = sup.isize*BLOCK_SIZE//INODE_SIZE
         acnt = 0
-        for i in range(1, icnt+1):
-            node = self.read_i_node(i)
-            if not node.is_allocated():
-                continue
+        for i in self.list_i_nodes(sup):
             acnt += 1
-            yield node
+            yield self.read_i_node(i)
         print('{} allocated / {} possible inodes'.format(acnt, icnt))
 
     def count_free_blocks(self):